@@ -1,9 +1,12 @@
-import requests
+import httpx
 from telegram import Update, Bot
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
 from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
+import codecs
 import sqlite3
 import asyncio
+import threading
 import os
 from datetime import datetime, timedelta
 import re
@@ -13,15 +16,61 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Регулярные выражения компилируем один раз при загрузке модуля
+ISIN_RE = re.compile(r'RU[0-9A-Z]{10}')
+ISIN_STRICT_RE = re.compile(r'^RU[0-9A-Z]{10}$')
+PAYMENT_RE = re.compile(r'(\d+[.,]\d+)\s*руб', re.IGNORECASE)
+DATE_CLASS_RE = re.compile('date')
+DATE_RE = re.compile(r'\d{2}\.\d{2}\.\d{4}')
+
+# Сколько байт страницы списка новостей читаем и разбираем
+MAX_LIST_BYTES = 262144
+
+# Подстрока в заголовке (в нижнем регистре) -> тип события, в порядке приоритета
+EVENT_MAP = (
+    ('выплата купонного дохода', 'Выплата купонного дохода'),
+    ('погашение', 'Погашение'),
+    ('оферта', 'Оферта'),
+)
+
+def parse_amount(text):
+    """Достаем сумму выплаты в рублях как число из текста вида '12,34 руб.'"""
+    match = PAYMENT_RE.search(text or '')
+    return float(match.group(1).replace(',', '.')) if match else None
+
+def parse_date(text):
+    """Переводим дату вида ДД.ММ.ГГГГ из текста в unix timestamp"""
+    match = DATE_RE.search(text or '')
+    if not match:
+        return None
+    return int(datetime.strptime(match.group(0), "%d.%m.%Y").timestamp())
+
 class NSDMonitor:
     def __init__(self):
+        # Одно соединение на все потоки, поэтому запросы выполняем по очереди
+        self.db_lock = threading.Lock()
+        # /check и плановая проверка не должны обрабатывать одни и те же новости одновременно
+        self.check_lock = asyncio.Lock()
         self.setup_database()
+        self.load_tracked_ids()
         self.base_url = "https://nsddata.ru"
+        self.setup_client()
+        # Валидаторы кэша для условного GET списка новостей
+        self.etag = None
+        self.last_modified = None
+        self.cached_news = []
         
     def setup_database(self):
         """Создаем базу данных для отслеживания новостей"""
         self.conn = sqlite3.connect('nsd_news.db', check_same_thread=False)
         cursor = self.conn.cursor()
+
+        # WAL: чтение не блокируется записью, меньше fsync на каждый commit
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-20000')  # ~20 МБ
+
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS tracked_news (
                 id INTEGER PRIMARY KEY,
@@ -29,17 +78,13 @@ class NSDMonitor:
                 isin TEXT,
                 title TEXT,
                 event_type TEXT,
-                payment_amount TEXT,
+                payment_amount REAL,
                 news_url TEXT,
-                published_date TEXT,
+                published_date INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        self.conn.commit()
-    
-    def add_isin_tracking(self, isin_code, user_id):
-        """Добавляем ISIN для отслеживания конкретным пользователем"""
-        cursor = self.conn.cursor()
+        self.migrate_tracked_news()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS user_isins (
                 user_id INTEGER,
@@ -48,74 +93,167 @@ class NSDMonitor:
                 UNIQUE(user_id, isin)
             )
         ''')
-        cursor.execute(
-            'INSERT OR IGNORE INTO user_isins (user_id, isin) VALUES (?, ?)',
-            (user_id, isin_code.upper())
-        )
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_isins_user ON user_isins(user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_isins_isin ON user_isins(isin)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tracked_news_isin ON tracked_news(isin)')
+        self.conn.commit()
+    
+    def migrate_tracked_news(self):
+        """Переводим старую таблицу с текстовыми суммой и датой на REAL/INTEGER"""
+        columns = {row[1]: row[2] for row in self.conn.execute('PRAGMA table_info(tracked_news)')}
+        if columns.get('payment_amount') != 'TEXT' and columns.get('published_date') != 'TEXT':
+            return
+        
+        logger.info("Миграция tracked_news: payment_amount -> REAL, published_date -> INTEGER")
+        rows = [
+            (row_id, parse_amount(payment_amount), parse_date(published_date))
+            for row_id, payment_amount, published_date in self.conn.execute(
+                'SELECT id, payment_amount, published_date FROM tracked_news'
+            )
+        ]
+        # DDL в sqlite3 по умолчанию коммитится сразу, поэтому всю перестройку
+        # выполняем в одной явной транзакции
         self.conn.commit()
+        isolation_level = self.conn.isolation_level
+        self.conn.isolation_level = None
+        try:
+            self.conn.execute('BEGIN')
+            self.conn.execute('ALTER TABLE tracked_news RENAME TO tracked_news_old')
+            self.conn.execute('''
+                CREATE TABLE tracked_news (
+                    id INTEGER PRIMARY KEY,
+                    news_id TEXT UNIQUE,
+                    isin TEXT,
+                    title TEXT,
+                    event_type TEXT,
+                    payment_amount REAL,
+                    news_url TEXT,
+                    published_date INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            self.conn.execute('''
+                INSERT INTO tracked_news (id, news_id, isin, title, event_type, news_url, created_at)
+                SELECT id, news_id, isin, title, event_type, news_url, created_at FROM tracked_news_old
+            ''')
+            self.conn.executemany(
+                'UPDATE tracked_news SET payment_amount = ?, published_date = ? WHERE id = ?',
+                [(payment_amount, published_date, row_id) for row_id, payment_amount, published_date in rows]
+            )
+            self.conn.execute('DROP TABLE tracked_news_old')
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        finally:
+            self.conn.isolation_level = isolation_level
+    
+    def setup_client(self):
+        """Создаем общий асинхронный HTTP-клиент с keep-alive и HTTP/2"""
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+            retries=3
+        )
+        self.aclient = httpx.AsyncClient(
+            transport=transport,
+            timeout=10.0,
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+            }
+        )
+    
+    async def run_db(self, func, *args):
+        """Выполняем синхронный запрос к SQLite в отдельном потоке, не блокируя event loop"""
+        def locked_call():
+            with self.db_lock:
+                return func(*args)
+        return await asyncio.to_thread(locked_call)
+    
+    def add_isin_tracking(self, isin_code, user_id):
+        """Добавляем ISIN для отслеживания конкретным пользователем"""
+        with self.conn:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO user_isins (user_id, isin) VALUES (?, ?)',
+                (user_id, isin_code.upper())
+            )
         return cursor.rowcount > 0
     
     def get_user_isins(self, user_id):
         """Получаем список ISIN пользователя"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT isin FROM user_isins WHERE user_id = ?', (user_id,))
-        return [row[0] for row in cursor.fetchall()]
+        return [row[0] for row in self.conn.execute('SELECT isin FROM user_isins WHERE user_id = ?', (user_id,))]
+    
+    def get_notifications(self, news_list):
+        """Возвращаем пары (user_id, новость) для пользователей, подписанных на ISIN новостей"""
+        rows = [(pos, news['isin']) for pos, news in enumerate(news_list) if news.get('isin')]
+        if not rows:
+            return []
+        with self.conn:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS news_batch (pos INTEGER, isin TEXT)')
+            self.conn.execute('DELETE FROM news_batch')
+            self.conn.executemany('INSERT INTO news_batch (pos, isin) VALUES (?, ?)', rows)
+            cursor = self.conn.execute('''
+                SELECT u.user_id, b.pos
+                FROM user_isins u JOIN news_batch b ON b.isin = u.isin
+                ORDER BY u.user_id, b.pos
+            ''')
+            return [(user_id, news_list[pos]) for user_id, pos in cursor]
+    
+    def load_tracked_ids(self):
+        """Загружаем news_id из базы в память, чтобы не ходить в SQLite на каждой проверке"""
+        self.tracked_ids = {row[0] for row in self.conn.execute('SELECT news_id FROM tracked_news')}
     
     def is_news_tracked(self, news_id):
         """Проверяем, есть ли новость в базе"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT 1 FROM tracked_news WHERE news_id = ?', (news_id,))
-        return cursor.fetchone() is not None
-    
-    def save_news(self, news_data):
-        """Сохраняем новость в базу"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT OR IGNORE INTO tracked_news 
-            (news_id, isin, title, event_type, payment_amount, news_url, published_date)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            news_data['news_id'],
-            news_data['isin'],
-            news_data['title'],
-            news_data['event_type'],
-            news_data['payment_amount'],
-            news_data['news_url'],
-            news_data['published_date']
-        ))
-        self.conn.commit()
-        return cursor.rowcount > 0
+        return news_id in self.tracked_ids
+    
+    def save_news_many(self, news_list):
+        """Сохраняем пачку новостей одной транзакцией, возвращаем реально вставленные"""
+        inserted = []
+        with self.conn:
+            for news_data in news_list:
+                cursor = self.conn.execute('''
+                    INSERT OR IGNORE INTO tracked_news 
+                    (news_id, isin, title, event_type, payment_amount, news_url, published_date)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    news_data['news_id'],
+                    news_data['isin'],
+                    news_data['title'],
+                    news_data['event_type'],
+                    news_data['payment_amount'],
+                    news_data['news_url'],
+                    news_data['published_date']
+                ))
+                if cursor.rowcount > 0:
+                    inserted.append(news_data)
+        self.tracked_ids.update(news_data['news_id'] for news_data in news_list)
+        return inserted
     
     def parse_news_page(self, html_content):
         """Парсим страницу с новостью и извлекаем структурированные данные"""
-        soup = BeautifulSoup(html_content, 'html.parser')
+        soup = BeautifulSoup(html_content, 'lxml')
         
         # Извлекаем заголовок
         title_element = soup.find('h1')
         title = title_element.get_text().strip() if title_element else "Неизвестно"
         
         # Ищем ISIN в тексте (формат RU000A106SE5)
-        isin_match = re.search(r'RU[0-9A-Z]{10}', title)
+        isin_match = ISIN_RE.search(title)
         isin = isin_match.group(0) if isin_match else None
         
         # Определяем тип события
-        event_type = "Неизвестно"
-        if 'выплата купонного дохода' in title.lower():
-            event_type = "Выплата купонного дохода"
-        elif 'погашение' in title.lower():
-            event_type = "Погашение"
-        elif 'оферта' in title.lower():
-            event_type = "Оферта"
+        title_lower = title.casefold()
+        event_type = next((value for key, value in EVENT_MAP if key in title_lower), "Неизвестно")
         
         # Ищем размер выплаты
-        payment_amount = None
-        payment_match = re.search(r'(\d+[.,]\d+)\s*руб', html_content, re.IGNORECASE)
-        if payment_match:
-            payment_amount = payment_match.group(1) + " руб."
+        payment_amount = parse_amount(html_content)
         
-        # Ищем дату публикации
-        date_element = soup.find('time') or soup.find('div', class_=re.compile('date'))
-        published_date = date_element.get_text().strip() if date_element else datetime.now().strftime("%d.%m.%Y")
+        # Ищем дату публикации (храним как unix timestamp)
+        date_element = soup.find('time') or soup.find('div', class_=DATE_CLASS_RE)
+        published_date = parse_date(date_element.get_text()) if date_element else None
+        if published_date is None:
+            published_date = int(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
         
         return {
             'title': title,
@@ -125,67 +263,123 @@ class NSDMonitor:
             'published_date': published_date
         }
     
-    def get_recent_news(self):
+    async def get_recent_news(self):
         """Получаем последние новости с главной страницы nsddata.ru"""
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
+            headers = {}
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
             
-            response = requests.get(f"{self.base_url}/ru/news", headers=headers, timeout=10)
-            response.encoding = 'utf-8'
-            
-            if response.status_code != 200:
-                logger.error(f"Ошибка доступа к сайту: {response.status_code}")
-                return []
+            async with self.aclient.stream('GET', f"{self.base_url}/ru/news", headers=headers) as response:
+                # Страница не изменилась - отдаем уже разобранный список без загрузки и парсинга
+                if response.status_code == 304:
+                    return list(self.cached_news)
+                
+                if response.status_code != 200:
+                    logger.error(f"Ошибка доступа к сайту: {response.status_code}")
+                    return []
+                
+                # Свежие новости в начале страницы, остаток не скачиваем
+                body = bytearray()
+                async for chunk in response.aiter_bytes():
+                    body += chunk
+                    if len(body) >= MAX_LIST_BYTES:
+                        break
             
-            soup = BeautifulSoup(response.text, 'html.parser')
+            # Для списка ссылок достаточно быстрого C-парсера selectolax
+            # final=False отбрасывает только символ, обрезанный на границе MAX_LIST_BYTES,
+            # остальные битые байты заменяются, а не теряются
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            tree = HTMLParser(decoder.decode(bytes(body[:MAX_LIST_BYTES]), final=False))
             
             # Ищем ссылки на новости (нужно адаптировать под структуру сайта)
             news_links = []
             
             # Вариант 1: Ищем по классам/тегам (нужно исследовать сайт)
-            news_elements = soup.find_all('a', href=re.compile(r'/ru/news/view/'))
+            news_elements = tree.css('a[href*="/ru/news/view/"]')
             
             for element in news_elements[:10]:  # Проверяем последние 10 новостей
-                href = element.get('href')
+                href = element.attributes.get('href')
                 if href and '/ru/news/view/' in href:
                     full_url = f"{self.base_url}{href}" if href.startswith('/') else href
                     news_id = href.split('/')[-1] if '/' in href else href
                     
-                    # Парсим каждую новость для получения деталей
-                    news_details = self.parse_news_page(response.text)  # Упрощенно
+                    title = element.text(strip=True) or "Без названия"
+                    isin_match = ISIN_RE.search(title)
                     
+                    # Остальные детали заполняются в fetch_news_details только для новых новостей
                     news_data = {
                         'news_id': news_id,
                         'news_url': full_url,
-                        'title': element.get_text(strip=True) or "Без названия",
-                        'isin': news_details.get('isin'),
-                        'event_type': news_details.get('event_type'),
-                        'payment_amount': news_details.get('payment_amount'),
-                        'published_date': news_details.get('published_date')
+                        'title': title,
+                        'isin': isin_match.group(0) if isin_match else None,
+                        'event_type': None,
+                        'payment_amount': None,
+                        'published_date': None
                     }
                     
                     news_links.append(news_data)
             
-            return news_links
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            self.cached_news = news_links
+            return list(news_links)
             
         except Exception as e:
             logger.error(f"Ошибка при получении новостей: {e}")
             return []
     
-    def check_new_news(self):
-        """Проверяем новые новости и возвращаем непрочитанные"""
-        recent_news = self.get_recent_news()
-        new_news = []
+    async def fetch_news_details(self, news_list):
+        """Параллельно загружаем страницы новостей и возвращаем те, что удалось дополнить деталями"""
+        responses = await asyncio.gather(
+            *[self.aclient.get(news['news_url']) for news in news_list],
+            return_exceptions=True
+        )
+        
+        loaded = []
+        for news, response in zip(news_list, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Ошибка загрузки новости {news['news_url']}: {response}")
+                continue
+            if response.status_code != 200:
+                logger.error(f"Ошибка доступа к новости {news['news_url']}: {response.status_code}")
+                continue
+            
+            response.encoding = 'utf-8'
+            news_details = self.parse_news_page(response.text)
+            news.update({
+                'isin': news_details.get('isin') or news.get('isin'),
+                'event_type': news_details.get('event_type'),
+                'payment_amount': news_details.get('payment_amount'),
+                'published_date': news_details.get('published_date')
+            })
+            loaded.append(news)
         
-        for news in recent_news:
-            if not self.is_news_tracked(news['news_id']):
-                if self.save_news(news):
+        return loaded
+    
+    async def check_new_news(self):
+        """Проверяем новые новости и возвращаем непрочитанные"""
+        async with self.check_lock:
+            recent_news = await self.get_recent_news()
+            
+            # Одна и та же новость может встретиться на странице дважды
+            new_news = []
+            seen_ids = set()
+            for news in recent_news:
+                if not self.is_news_tracked(news['news_id']) and news['news_id'] not in seen_ids:
+                    seen_ids.add(news['news_id'])
                     new_news.append(news)
+            
+            if new_news:
+                # Неудачно загруженные не сохраняем - попробуем снова при следующей проверке
+                new_news = await self.fetch_news_details(new_news)
+                new_news = await self.run_db(self.save_news_many, new_news)
+                for news in new_news:
                     logger.info(f"Новая новость: {news['title']}")
-        
-        return new_news
+            
+            return new_news
 
 # Создаем экземпляр монитора
 nsd_monitor = NSDMonitor()
@@ -213,18 +407,18 @@ async def add_isin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Валидация ISIN
-    if not re.match(r'^RU[0-9A-Z]{10}$', isin_code):
+    if not ISIN_STRICT_RE.match(isin_code):
         await update.message.reply_text("❌ Неверный формат ISIN. Пример: RU000A106SE5")
         return
     
-    if nsd_monitor.add_isin_tracking(isin_code, user_id):
+    if await nsd_monitor.run_db(nsd_monitor.add_isin_tracking, isin_code, user_id):
         await update.message.reply_text(f"✅ ISIN `{isin_code}` добавлен для отслеживания", parse_mode='Markdown')
     else:
         await update.message.reply_text(f"⚠️ ISIN `{isin_code}` уже отслеживается", parse_mode='Markdown')
 
 async def list_isins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_isins = nsd_monitor.get_user_isins(user_id)
+    user_isins = await nsd_monitor.run_db(nsd_monitor.get_user_isins, user_id)
     
     if not user_isins:
         await update.message.reply_text("📭 У вас нет отслеживаемых ISIN кодов")
@@ -235,7 +429,7 @@ async def list_isins(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def manual_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_isins = nsd_monitor.get_user_isins(user_id)
+    user_isins = await nsd_monitor.run_db(nsd_monitor.get_user_isins, user_id)
     
     if not user_isins:
         await update.message.reply_text("❌ Сначала добавьте ISIN коды для отслеживания")
@@ -243,7 +437,7 @@ async def manual_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("🔍 Проверяю последние новости...")
     
-    new_news = nsd_monitor.check_new_news()
+    new_news = await nsd_monitor.check_new_news()
     relevant_news = [news for news in new_news if news.get('isin') in user_isins]
     
     if relevant_news:
@@ -255,43 +449,66 @@ async def manual_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_last_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает последние новости (для тестирования)"""
-    recent_news = nsd_monitor.get_recent_news()[:5]  # Последние 5 новостей
+    recent_news = (await nsd_monitor.get_recent_news())[:5]  # Последние 5 новостей
     
     if not recent_news:
         await update.message.reply_text("❌ Не удалось получить новости")
         return
     
-    message = "📰 **Последние новости:**\n\n"
+    parts = ["📰 **Последние новости:**\n\n"]
     for news in recent_news:
-        message += f"• {news['title'][:50]}...\n"
+        parts.append(f"• {news['title'][:50]}...\n")
         if news.get('isin'):
-            message += f"  ISIN: `{news['isin']}`\n"
-        message += "\n"
+            parts.append(f"  ISIN: `{news['isin']}`\n")
+        parts.append("\n")
     
-    await update.message.reply_text(message, parse_mode='Markdown')
+    await update.message.reply_text("".join(parts), parse_mode='Markdown')
+
+def format_amount(amount):
+    """Форматирует сумму выплаты с запятой, как на nsddata.ru"""
+    # Не больше 6 знаков после запятой и не меньше 2, без экспоненты и хвостов float
+    integer, fraction = f"{amount:.6f}".split('.')
+    fraction = fraction.rstrip('0').ljust(2, '0')
+    return f"{integer},{fraction}"
 
 def format_news_message(news):
     """Форматирует сообщение о новости в красивом виде"""
-    message = "👔 **НОВОЕ СОБЫТИЕ**\n\n"
+    parts = ["👔 **НОВОЕ СОБЫТИЕ**\n\n"]
     
     if news.get('isin'):
-        message += f"`{news['isin']}`\n\n"
+        parts.append(f"`{news['isin']}`\n\n")
     
-    if news.get('published_date'):
-        message += f"🗓 *{news['published_date']}*\n"
+    if news.get('published_date') is not None:
+        published_date = datetime.fromtimestamp(news['published_date']).strftime("%d.%m.%Y")
+        parts.append(f"🗓 *{published_date}*\n")
     
     if news.get('event_type'):
-        message += f"📋 *{news['event_type']}*\n\n"
+        parts.append(f"📋 *{news['event_type']}*\n\n")
     
-    message += f"*{news['title']}*\n"
+    parts.append(f"*{news['title']}*\n")
     
-    if news.get('payment_amount'):
-        message += f"\n💰 *Размер выплаты:* {news['payment_amount']}"
+    if news.get('payment_amount') is not None:
+        parts.append(f"\n💰 *Размер выплаты:* {format_amount(news['payment_amount'])} руб.")
     
     if news.get('news_url'):
-        message += f"\n\n🔗 [Подробнее]({news['news_url']})"
+        parts.append(f"\n\n🔗 [Подробнее]({news['news_url']})")
     
-    return message
+    return "".join(parts)
+
+async def send_user_notifications(bot, user_id, news_list):
+    """Отправляет пользователю его новости по очереди"""
+    for i, news in enumerate(news_list):
+        if i:
+            # Задержка между сообщениями в один чат, чтобы не упереться в лимит Telegram
+            await asyncio.sleep(1)
+        try:
+            await bot.send_message(
+                chat_id=user_id,
+                text=format_news_message(news),
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
 
 # Фоновая задача для автоматической проверки
 async def scheduled_news_check(context: ContextTypes.DEFAULT_TYPE):
@@ -299,34 +516,29 @@ async def scheduled_news_check(context: ContextTypes.DEFAULT_TYPE):
     logger.info("🔍 Автоматическая проверка новостей...")
     
     try:
-        new_news = nsd_monitor.check_new_news()
+        new_news = await nsd_monitor.check_new_news()
         
         if new_news:
-            # Для каждого пользователя фильтруем релевантные новости
-            cursor = nsd_monitor.conn.cursor()
-            cursor.execute('SELECT DISTINCT user_id FROM user_isins')
-            users = cursor.fetchall()
+            # Одним JOIN-запросом получаем, кому какую новость отправить
+            notifications = await nsd_monitor.run_db(nsd_monitor.get_notifications, new_news)
             
-            for (user_id,) in users:
-                user_isins = nsd_monitor.get_user_isins(user_id)
-                relevant_news = [news for news in new_news if news.get('isin') in user_isins]
-                
-                for news in relevant_news:
-                    message = format_news_message(news)
-                    try:
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=message,
-                            parse_mode='Markdown'
-                        )
-                        # Задержка между сообщениями чтобы не спамить
-                        await asyncio.sleep(1)
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
+            # Сообщения одному пользователю идут по порядку, разные пользователи - параллельно
+            user_news = {}
+            for user_id, news in notifications:
+                user_news.setdefault(user_id, []).append(news)
+            
+            await asyncio.gather(*[
+                send_user_notifications(context.bot, user_id, news_list)
+                for user_id, news_list in user_news.items()
+            ])
     
     except Exception as e:
         logger.error(f"Ошибка в scheduled_news_check: {e}")
 
+async def close_client(application: Application):
+    """Закрываем HTTP-клиент при остановке бота"""
+    await nsd_monitor.aclient.aclose()
+
 def main():
     BOT_TOKEN = os.environ.get('BOT_TOKEN')
     
@@ -335,7 +547,22 @@ def main():
         return
     
     # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Лимиты Telegram соблюдает AIORateLimiter: 30 сообщений/сек всего и 20/мин в группу,
+    # при RetryAfter ждет указанное время и повторяет отправку
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=30,
+        overall_time_period=1,
+        group_max_rate=20,
+        group_time_period=60,
+        max_retries=3
+    )
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(rate_limiter)
+        .post_shutdown(close_client)
+        .build()
+    )
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))